@@ -1,12 +1,293 @@
 from .. import loader, utils
+import abc
 import asyncio
+import base64
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import copy
+import functools
+import heapq
+import itertools
+import json
 import time
 import re
 import logging
-from telethon.tl.types import Message
+import logging.handlers
+import sqlite3
+import statistics
+import types
+import uuid
+from telethon.errors import FileReferenceExpiredError, UsernameInvalidError, UsernameNotOccupiedError
+from telethon.tl.types import InputDocument, InputMessagesFilterMusic, Message
 
 logger = logging.getLogger(__name__)
 
+_current_trace = contextvars.ContextVar("sheomus_trace", default=None)
+_current_capture = contextvars.ContextVar("sheomus_capture", default=None)
+
+
+class SearchTrace:
+    """Трассировка одного поиска: идентификатор и этапы с задержками"""
+
+    def __init__(self, kind, query):
+        self.trace_id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.query = query
+        self.started = time.time()
+        self.spans = []
+
+    def span(self, name, **fields):
+        """Добавляет этап с отметкой времени от начала поиска"""
+        fields['span'] = name
+        fields['at_ms'] = int((time.time() - self.started) * 1000)
+        self.spans.append(fields)
+
+    @property
+    def duration_ms(self):
+        return int((time.time() - self.started) * 1000)
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'kind': self.kind,
+            'query': self.query,
+            'started': self.started,
+            'duration_ms': self.duration_ms,
+            'spans': self.spans
+        }
+
+
+class SearchClient:
+    """Клиент для инлайн-запросов с бюджетом запросов и учетом FloodWait"""
+
+    def __init__(self, client, rate=30, period=60.0):
+        self.client = client
+        self.rate = rate
+        self.period = period
+        self.tokens = float(rate)
+        self.updated = time.time()
+        self.flood_until = 0.0
+        self.queries = 0
+
+    def budget(self):
+        """Возвращает доступное число запросов с учетом пополнения"""
+        now = time.time()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.period)
+        self.updated = now
+        if now < self.flood_until:
+            return 0.0
+        return self.tokens
+
+    def take(self):
+        """Списывает один запрос из бюджета"""
+        self.budget()
+        self.tokens -= 1
+        self.queries += 1
+
+    def flood(self, seconds):
+        """Отмечает FloodWait: клиент не используется указанное время"""
+        self.flood_until = max(self.flood_until, time.time() + seconds)
+
+
+class CacheBackend(abc.ABC):
+    """Хранилище кэша результатов и ссылок на документы с пакетным доступом"""
+
+    # Хранилище видно другим процессам: его данные могли записать другие аккаунты
+    shared = True
+
+    @abc.abstractmethod
+    async def get_many(self, namespace, keys):
+        """Возвращает словарь найденных непросроченных значений по ключам"""
+
+    @abc.abstractmethod
+    async def set_many(self, namespace, items, ttl):
+        """Сохраняет пары ключ-значение на ttl секунд"""
+
+    async def close(self):
+        pass
+
+
+class MemoryCacheBackend(CacheBackend):
+    """Хранилище в памяти процесса (по умолчанию)"""
+
+    shared = False
+
+    def __init__(self, max_items=2000):
+        self.max_items = max_items
+        self.data = {}
+
+    async def get_many(self, namespace, keys):
+        now = time.time()
+        found = {}
+        for key in keys:
+            entry = self.data.get((namespace, key))
+            if entry and entry[0] > now:
+                found[key] = entry[1]
+        return found
+
+    async def set_many(self, namespace, items, ttl):
+        expires = time.time() + ttl
+        for key, value in items.items():
+            self.data.pop((namespace, key), None)
+            self.data[(namespace, key)] = (expires, value)
+        while len(self.data) > self.max_items:
+            del self.data[next(iter(self.data))]
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """Общее хранилище в SQLite (WAL) для нескольких экземпляров модуля
+
+    Все обращения к базе выполняются в отдельном потоке, чтобы не блокировать цикл событий.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.connection = None
+        self.writes = 0
+
+    def _connect(self):
+        if not self.connection:
+            self.connection = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "namespace TEXT, key TEXT, value TEXT, expires REAL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+        return self.connection
+
+    def _get_many(self, namespace, keys):
+        connection = self._connect()
+        placeholders = ",".join("?" for _ in keys)
+        rows = connection.execute(
+            f"SELECT key, value FROM cache WHERE namespace = ? AND expires > ? AND key IN ({placeholders})",
+            [namespace, time.time(), *keys]
+        ).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def _set_many(self, namespace, items, ttl):
+        connection = self._connect()
+        expires = time.time() + ttl
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO cache (namespace, key, value, expires) VALUES (?, ?, ?, ?)",
+                [(namespace, key, json.dumps(value), expires) for key, value in items.items()]
+            )
+            self.writes += 1
+            if self.writes % 100 == 0:
+                connection.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+
+    def _close(self):
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def get_many(self, namespace, keys):
+        if not keys:
+            return {}
+        return await self._run(self._get_many, namespace, list(keys))
+
+    async def set_many(self, namespace, items, ttl):
+        if items:
+            await self._run(self._set_many, namespace, dict(items), ttl)
+
+    async def close(self):
+        await self._run(self._close)
+        self.executor.shutdown(wait=False)
+
+
+class ReplayClient:
+    """Клиент, отвечающий на инлайн-запросы из записанного журнала поиска"""
+
+    def __init__(self, answers):
+        self.answers = {}
+        for answer in answers:
+            key = (answer['bot'].lower(), answer['query'], answer['offset'])
+            self.answers.setdefault(key, answer)
+        self.queries = 0
+        self.missing = 0
+
+    async def inline_query(self, bot, query, offset=None):
+        answer = self.answers.get((str(bot).lower(), query, offset or None))
+        if not answer:
+            self.queries += 1
+            self.missing += 1
+            return []
+        
+        # Ответ из кэша ответов и пропуск из-за бюджета в живом поиске обошлись без запроса к боту
+        if answer['outcome'] not in ("cache", "no_budget"):
+            self.queries += 1
+            await asyncio.sleep(answer['latency_ms'] / 1000)
+        if answer['outcome'] == "timeout":
+            raise asyncio.TimeoutError()
+        if answer['outcome'] == "error":
+            raise RuntimeError("записанная ошибка бота")
+        
+        results = []
+        for item in answer['results']:
+            attribute = types.SimpleNamespace(title=item['title'], performer=item['performer'])
+            document = types.SimpleNamespace(
+                id=item['doc_id'],
+                access_hash=0,
+                file_reference=b'',
+                attributes=[attribute]
+            )
+            results.append(types.SimpleNamespace(
+                result=types.SimpleNamespace(document=document, title=item['raw_title'])
+            ))
+        return results
+
+
+class ReplayDatabase(dict):
+    """База в памяти для изолированного экземпляра модуля при воспроизведении"""
+
+    def get(self, owner, key, default=None):
+        return super().get((owner, key), default)
+
+    def set(self, owner, key, value):
+        self[(owner, key)] = value
+
+
+class SettingsSnapshot:
+    """Снимок настроек модуля: чтение без обращения к базе, запись сквозная"""
+
+    def __init__(self, database):
+        self.database = database
+        self.emojis_enabled = True
+        self.music_bots = []
+        self.allowed_chats = []
+        self.bots_lower = frozenset()
+        self.allowed_chat_set = frozenset()
+        self.reload()
+
+    def reload(self):
+        """Перечитывает настройки из базы"""
+        self.emojis_enabled = self.database.get("SheoMus", "emojis_enabled", True)
+        self._apply("music_bots", self.database.get("SheoMus", "music_bots", []))
+        self._apply("allowed_chats", self.database.get("SheoMus", "allowed_chats", []))
+
+    def update(self, key, value):
+        """Сохраняет значение в базу и пересчитывает производные структуры"""
+        self.database.set("SheoMus", key, value)
+        self._apply(key, value)
+
+    def _apply(self, key, value):
+        if key == "music_bots":
+            self.music_bots = list(value or [])
+            self.bots_lower = frozenset(b.lower() for b in self.music_bots)
+        elif key == "allowed_chats":
+            self.allowed_chats = list(value or [])
+            self.allowed_chat_set = frozenset(self.allowed_chats)
+        else:
+            setattr(self, key, value)
+
 
 class SheoMusMod(loader.Module):
     """Модуль для поиска музыки от @XSheo."""
@@ -15,13 +296,177 @@ class SheoMusMod(loader.Module):
 
     def __init__(self):
         try:
+            self.config = loader.ModuleConfig(
+                loader.ConfigValue(
+                    "negative_cache_ttl",
+                    30,
+                    lambda: "Сколько секунд запрос без результата сразу отвечает «Музыка не найдена»",
+                    validator=loader.validators.Integer(minimum=0)
+                ),
+                loader.ConfigValue(
+                    "deadline_m",
+                    2.5,
+                    lambda: "Бюджет времени на поиск командой .м, секунд (0 - без ограничения)",
+                    validator=loader.validators.Float(minimum=0)
+                ),
+                loader.ConfigValue(
+                    "deadline_find",
+                    4.0,
+                    lambda: "Бюджет времени на поиск по слову «найти», секунд (0 - без ограничения)",
+                    validator=loader.validators.Float(minimum=0)
+                ),
+                loader.ConfigValue(
+                    "deadline_menu",
+                    6.0,
+                    lambda: "Бюджет времени на меню .ми / «найтими» / «Ещё», секунд (0 - без ограничения)",
+                    validator=loader.validators.Float(minimum=0)
+                ),
+                loader.ConfigValue(
+                    "deadline_min_score",
+                    10,
+                    lambda: "Минимальная оценка лучшего результата, отдаваемого по истечении бюджета",
+                    validator=loader.validators.Integer(minimum=0)
+                ),
+                loader.ConfigValue(
+                    "raw_cache_ttl",
+                    120,
+                    lambda: "Сколько секунд хранить ответы ботов на одинаковый запрос (общие для .м и .ми)",
+                    validator=loader.validators.Integer(minimum=0)
+                ),
+                loader.ConfigValue(
+                    "cache_backend",
+                    "memory",
+                    lambda: "Хранилище кэша результатов: memory - в процессе, sqlite - общий файл для нескольких аккаунтов",
+                    validator=loader.validators.Choice(["memory", "sqlite"])
+                ),
+                loader.ConfigValue(
+                    "cache_path",
+                    "sheomus_cache.sqlite",
+                    lambda: "Путь к файлу SQLite для общего кэша (например, на общем томе)",
+                    validator=loader.validators.String()
+                ),
+                loader.ConfigValue(
+                    "bot_wave_size",
+                    2,
+                    lambda: "Сколько лучших по истории ботов опрашивать до подключения остальных",
+                    validator=loader.validators.Integer(minimum=1)
+                ),
+                loader.ConfigValue(
+                    "trace_enabled",
+                    False,
+                    lambda: "Трассировка поисков и запись медленных в журнал",
+                    validator=loader.validators.Boolean()
+                ),
+                loader.ConfigValue(
+                    "slow_search_ms",
+                    5000,
+                    lambda: "Поиски дольше этого порога (мс) записываются в журнал",
+                    validator=loader.validators.Integer(minimum=0)
+                ),
+                loader.ConfigValue(
+                    "slow_log_path",
+                    "sheomus_slow.jsonl",
+                    lambda: "Файл журнала медленных поисков (JSONL, с ротацией)",
+                    validator=loader.validators.String()
+                ),
+                loader.ConfigValue(
+                    "search_client_rate",
+                    30,
+                    lambda: "Сколько инлайн-запросов в минуту распределять на один аккаунт",
+                    validator=loader.validators.Integer(minimum=1)
+                ),
+                loader.ConfigValue(
+                    "history_search",
+                    False,
+                    lambda: "Искать трек среди аудио текущего чата и Избранного до обращения к ботам",
+                    validator=loader.validators.Boolean()
+                ),
+                loader.ConfigValue(
+                    "history_limit",
+                    20,
+                    lambda: "Сколько аудио просматривать в каждом чате при поиске по истории",
+                    validator=loader.validators.Integer(minimum=1, maximum=100)
+                ),
+                loader.ConfigValue(
+                    "history_timeout",
+                    0.3,
+                    lambda: "Ограничение времени поиска по истории, в секундах",
+                    validator=loader.validators.Float(minimum=0.05)
+                ),
+                loader.ConfigValue(
+                    "capture_enabled",
+                    False,
+                    lambda: "Записывать запросы, ответы ботов и выбранный трек для replaym",
+                    validator=loader.validators.Boolean()
+                ),
+                loader.ConfigValue(
+                    "capture_path",
+                    "sheomus_capture.jsonl",
+                    lambda: "Файл журнала запросов (JSONL, с ротацией)",
+                    validator=loader.validators.String()
+                ),
+                loader.ConfigValue(
+                    "queue_workers",
+                    2,
+                    lambda: "Сколько поисков без префикса выполняется одновременно",
+                    validator=loader.validators.Integer(minimum=1)
+                ),
+                loader.ConfigValue(
+                    "queue_max_depth",
+                    20,
+                    lambda: "Максимум поисков без префикса в очереди",
+                    validator=loader.validators.Integer(minimum=1)
+                ),
+                loader.ConfigValue(
+                    "queue_chat_depth",
+                    5,
+                    lambda: "Максимум поисков в очереди от одного чата",
+                    validator=loader.validators.Integer(minimum=1)
+                ),
+            )
             self.database = None
+            self.settings = None
             self.client = None
-            self.search_lock = asyncio.Lock()
+            self.inflight_searches = {}
+            self.budget_skips = 0
             self.spam_protection = {}
             self.cache = {}
             self.sent_tracks = {}
             self.failed_bots = {}
+            self.doc_refs = {}
+            self.negative_cache = {}
+            self.pick_stats = {'bots': {}, 'queries': {}}
+            self.bot_stats = {}
+            self.search_clients = []
+            self.inline_results = {}
+            self.page_states = {}
+            self.raw_cache = {}
+            self.raw_cache_stats = {}
+            self.cache_backend = None
+            self._backend_tasks = set()
+            self.bot_peers = {}
+            self.unresolved_bots = {}
+            self._resolve_tasks = set()
+            self.send_stats = {}
+            self._primary_search_client = None
+            self.deletion_queue = []
+            self._deletion_counter = itertools.count()
+            self._deletion_wakeup = None
+            self._deletion_task = None
+            self.search_queues = {}
+            self._queue_order = collections.deque()
+            self._queue_size = 0
+            self._queue_wakeup = None
+            self._queue_workers = []
+            self._warm_state_task = None
+            self._slow_log = None
+            self._capture_log = None
+            self.queue_metrics = {
+                'processed': 0,
+                'shed': 0,
+                'max_depth': 0,
+                'waits': collections.deque(maxlen=100)
+            }
             super().__init__()
         except Exception as e:
             logger.error(f"Ошибка инициализации SheoMus: {e}")
@@ -32,10 +477,45 @@ class SheoMusMod(loader.Module):
 
     async def on_unload(self):
         """Вызывается при выгрузке модуля"""
+        await self._stop_search_workers()
+        await self._stop_deletion_scheduler()
+        
+        if self._warm_state_task:
+            self._warm_state_task.cancel()
+            self._warm_state_task = None
+        for task in self._resolve_tasks:
+            task.cancel()
+        if self.database:
+            self._save_warm_state()
+        
+        if self._backend_tasks:
+            await asyncio.gather(*self._backend_tasks, return_exceptions=True)
+        if self.cache_backend:
+            await self.cache_backend.close()
+            self.cache_backend = None
+        
         self.sent_tracks.clear()
         self.cache.clear()
         self.spam_protection.clear()
         self.failed_bots.clear()
+        self.doc_refs.clear()
+        self.inline_results.clear()
+        self.page_states.clear()
+        self.raw_cache.clear()
+        self.raw_cache_stats.clear()
+        self.negative_cache.clear()
+        self.inflight_searches.clear()
+        self.bot_stats.clear()
+        self.bot_peers.clear()
+        self.unresolved_bots.clear()
+        
+        for jsonl_log in (self._slow_log, self._capture_log):
+            if jsonl_log:
+                for handler in jsonl_log.handlers[:]:
+                    handler.close()
+                    jsonl_log.removeHandler(handler)
+        self._slow_log = None
+        self._capture_log = None
 
     async def client_ready(self, client, database):
         self.client = client
@@ -57,6 +537,94 @@ class SheoMusMod(loader.Module):
         if not self.database.get("SheoMus", "emojis_enabled"):
             self.database.set("SheoMus", "emojis_enabled", True)
 
+        self.settings = SettingsSnapshot(self.database)
+        
+        if self.config["cache_backend"] == "sqlite":
+            self.cache_backend = SQLiteCacheBackend(self.config["cache_path"])
+        else:
+            self.cache_backend = MemoryCacheBackend()
+        self._primary_search_client = SearchClient(client, self.config["search_client_rate"])
+        self._load_warm_state()
+        self.pick_stats = copy.deepcopy(self.database.get("SheoMus", "pick_stats", None)) or {'bots': {}, 'queries': {}}
+
+        self._start_deletion_scheduler()
+        self._start_search_workers()
+        
+        if not self._warm_state_task or self._warm_state_task.done():
+            self._warm_state_task = asyncio.ensure_future(self._warm_state_loop())
+        
+        self._schedule_resolve(self.music_bots)
+
+    def _save_warm_state(self):
+        """Сохраняет кэш результатов, состояние ботов и их статистику в базу"""
+        now = time.time()
+        cache = {
+            key: entry for key, entry in self.cache.items()
+            if now - entry['time'] < 21600 and entry['doc_id'] in self.doc_refs
+        }
+        doc_refs = [
+            [
+                ref['id'],
+                ref['access_hash'],
+                base64.b64encode(ref['file_reference']).decode(),
+                ref['bot'],
+                ref['query'],
+                ref['result_id']
+            ]
+            for ref in (self.doc_refs[entry['doc_id']] for entry in cache.values())
+        ]
+        
+        self.database.set("SheoMus", "warm_state", {
+            'version': 1,
+            'saved_at': now,
+            'cache': cache,
+            'doc_refs': doc_refs,
+            'failed_bots': dict(self.failed_bots),
+            'bot_stats': {bot: dict(stats) for bot, stats in self.bot_stats.items()}
+        })
+        # Счетчики выборов меняются на каждом меню - в базу они попадают только здесь
+        self.database.set("SheoMus", "pick_stats", copy.deepcopy(self.pick_stats))
+
+    def _load_warm_state(self):
+        """Восстанавливает сохраненное состояние после перезапуска"""
+        state = self.database.get("SheoMus", "warm_state", None)
+        if not state or state.get('version') != 1:
+            return
+        
+        now = time.time()
+        try:
+            for doc_id, access_hash, file_reference, bot, query, result_id in state.get('doc_refs', []):
+                self.doc_refs[doc_id] = {
+                    'id': doc_id,
+                    'access_hash': access_hash,
+                    'file_reference': base64.b64decode(file_reference),
+                    'bot': bot,
+                    'query': query,
+                    'result_id': result_id
+                }
+            
+            for key, entry in state.get('cache', {}).items():
+                if now - entry['time'] < 21600 and entry['doc_id'] in self.doc_refs:
+                    self.cache[key] = entry
+            
+            for bot, fail_time in state.get('failed_bots', {}).items():
+                if now - fail_time < 3600:
+                    self.failed_bots[bot] = fail_time
+            
+            for bot, stats in state.get('bot_stats', {}).items():
+                self.bot_stats[bot] = dict(stats)
+        except Exception as e:
+            logger.error(f"Не удалось восстановить сохраненное состояние SheoMus: {e}")
+
+    async def _warm_state_loop(self):
+        """Периодически сохраняет состояние на случай аварийного перезапуска"""
+        while True:
+            await asyncio.sleep(300)
+            try:
+                self._save_warm_state()
+            except Exception as e:
+                logger.error(f"Ошибка сохранения состояния SheoMus: {e}")
+
     def _get_topic_id(self, message):
         """Получает ID темы из сообщения"""
         try:
@@ -222,27 +790,27 @@ class SheoMusMod(loader.Module):
 
     @property
     def allowed_chats(self):
-        return self.database.get("SheoMus", "allowed_chats", [])
+        return self.settings.allowed_chats
 
     @allowed_chats.setter
     def allowed_chats(self, value):
-        self.database.set("SheoMus", "allowed_chats", value)
+        self.settings.update("allowed_chats", value)
 
     @property
     def music_bots(self):
-        return self.database.get("SheoMus", "music_bots", [])
+        return self.settings.music_bots
 
     @music_bots.setter
     def music_bots(self, value):
-        self.database.set("SheoMus", "music_bots", value)
+        self.settings.update("music_bots", value)
 
     @property
     def emojis_enabled(self):
-        return self.database.get("SheoMus", "emojis_enabled", True)
+        return self.settings.emojis_enabled
 
     @emojis_enabled.setter
     def emojis_enabled(self, value):
-        self.database.set("SheoMus", "emojis_enabled", value)
+        self.settings.update("emojis_enabled", value)
 
     def clock_emoji(self):
         """Возвращает эмодзи часов или текст в зависимости от настройки"""
@@ -289,7 +857,327 @@ class SheoMusMod(loader.Module):
         except Exception:
             return str(hash(str(document)))
 
+    def _remember_document(self, document, bot_username, query, result_id, primary=True, offset=None):
+        """Сохраняет ссылку на документ и его происхождение (бот, запрос, позиция)"""
+        doc_id = getattr(document, 'id', None)
+        access_hash = getattr(document, 'access_hash', None)
+        if doc_id is None or access_hash is None:
+            return
+        
+        self.doc_refs.pop(doc_id, None)
+        self.doc_refs[doc_id] = {
+            'id': doc_id,
+            'access_hash': access_hash,
+            'file_reference': getattr(document, 'file_reference', b'') or b'',
+            'bot': bot_username,
+            'query': query,
+            'result_id': result_id,
+            'primary': primary,
+            'offset': offset,
+            'hit_pending': True
+        }
+        
+        while len(self.doc_refs) > 1000:
+            del self.doc_refs[next(iter(self.doc_refs))]
+
+    def _input_document(self, doc_id):
+        """Собирает InputDocument из сохраненной ссылки"""
+        ref = self.doc_refs.get(doc_id)
+        if not ref:
+            return None
+        return InputDocument(
+            id=ref['id'],
+            access_hash=ref['access_hash'],
+            file_reference=ref['file_reference']
+        )
+
+    def _export_ref(self, ref):
+        """Переводит ссылку на документ в JSON-совместимый вид"""
+        data = dict(ref)
+        data['file_reference'] = base64.b64encode(ref['file_reference']).decode()
+        return data
+
+    def _import_ref(self, data):
+        """Восстанавливает ссылку на документ, полученную из общего кэша"""
+        ref = dict(data)
+        ref['file_reference'] = base64.b64decode(data['file_reference'])
+        # Ссылка из общего хранилища могла быть получена другим аккаунтом - при ошибке отправки обновляем своим
+        if self.cache_backend.shared:
+            ref['primary'] = False
+        # Попадание засчитывается только ответу бота, полученному этим модулем
+        ref['hit_pending'] = False
+        self.doc_refs.pop(ref['id'], None)
+        self.doc_refs[ref['id']] = ref
+        return ref
+
+    def _publish(self, namespace, items, ttl):
+        """Записывает значения в хранилище кэша в фоне"""
+        if not self.cache_backend or not items:
+            return
+        
+        async def write():
+            try:
+                await self.cache_backend.set_many(namespace, items, ttl)
+            except Exception as e:
+                logger.error(f"Ошибка записи в хранилище кэша: {e}")
+        
+        task = asyncio.ensure_future(write())
+        self._backend_tasks.add(task)
+        task.add_done_callback(self._backend_tasks.discard)
+
+    async def _resolve_bot_peers(self, bots, delay=0):
+        """Параллельно получает input peer ботов, чтобы не разрешать username при каждом поиске"""
+        bots = list(bots)
+        if not bots or not self.client:
+            return
+        if delay:
+            await asyncio.sleep(delay)
+        
+        retry = []
+        results = await asyncio.gather(
+            *(asyncio.wait_for(self.client.get_input_entity(bot), timeout=10) for bot in bots),
+            return_exceptions=True
+        )
+        for bot, peer in zip(bots, results):
+            key = bot.lower()
+            if isinstance(peer, BaseException):
+                self.bot_peers.pop(key, None)
+                if self._is_unknown_username(peer):
+                    self.unresolved_bots[key] = (time.time(), str(peer) or type(peer).__name__)
+                    logger.warning(f"Не удалось найти бота @{bot}, он исключен из поиска: {peer}")
+                else:
+                    # Таймаут, FloodWait или сеть: ищем по username и повторяем позже
+                    retry.append(bot)
+                    logger.debug(f"Не удалось получить peer бота @{bot}, повторим позже: {peer!r}")
+            else:
+                self.bot_peers[key] = peer
+                self.unresolved_bots.pop(key, None)
+        
+        if retry:
+            self._schedule_resolve(retry, delay=60)
+
+    def _is_unknown_username(self, error):
+        """Проверяет, что ошибка означает несуществующий username, а не временный сбой"""
+        if isinstance(error, (UsernameNotOccupiedError, UsernameInvalidError)):
+            return True
+        error_str = str(error)
+        return isinstance(error, ValueError) and (
+            "No user has" in error_str or "Cannot find any entity" in error_str
+        )
+
+    def _schedule_resolve(self, bots, delay=0):
+        """Запускает разрешение peer ботов в фоне"""
+        task = asyncio.ensure_future(self._resolve_bot_peers(bots, delay))
+        self._resolve_tasks.add(task)
+        task.add_done_callback(self._resolve_tasks.discard)
+
+    def _bot_peer(self, bot_username):
+        """Возвращает сохраненный input peer бота или его username"""
+        return self.bot_peers.get(bot_username.lower(), bot_username)
+
+    async def _fetch_shared(self, namespace, keys):
+        """Читает значения из хранилища кэша, не прерывая поиск при ошибке"""
+        if not self.cache_backend:
+            return {}
+        try:
+            return await self.cache_backend.get_many(namespace, keys)
+        except Exception as e:
+            logger.error(f"Ошибка чтения из хранилища кэша: {e}")
+            return {}
+
+    async def _refresh_document(self, document):
+        """Обновляет file_reference одним инлайн-запросом к исходному боту"""
+        doc_id = getattr(document, 'id', None)
+        ref = self.doc_refs.get(doc_id)
+        if not ref and doc_id is not None:
+            shared = await self._fetch_shared("doc_refs", [str(doc_id)])
+            if shared:
+                ref = self._import_ref(shared[str(doc_id)])
+        if not ref:
+            return None
+        
+        try:
+            results = await asyncio.wait_for(
+                self.client.inline_query(self._bot_peer(ref['bot']), ref['query'], offset=ref.get('offset')),
+                timeout=3.0
+            )
+        except Exception as e:
+            logger.error(f"Не удалось обновить ссылку на документ {ref['id']} через {ref['bot']}: {e}")
+            return None
+        
+        if not results or not hasattr(results, '__iter__'):
+            return None
+        
+        # Сначала проверяем исходную позицию, затем остальные результаты
+        candidates = []
+        if 0 <= ref['result_id'] < len(results):
+            candidates.append(results[ref['result_id']])
+        candidates.extend(results)
+        
+        for result in candidates:
+            doc = getattr(result.result, 'document', None)
+            if doc and getattr(doc, 'id', None) == ref['id']:
+                self._remember_document(doc, ref['bot'], ref['query'], ref['result_id'], offset=ref.get('offset'))
+                # Обновление ссылки - не новый ответ бота, попадание по нему не засчитывается
+                self.doc_refs[ref['id']]['hit_pending'] = ref.get('hit_pending', False)
+                self._publish("doc_refs", {str(ref['id']): self._export_ref(self.doc_refs[ref['id']])}, 86400)
+                return doc
+        
+        return None
+
+    def _remember_inline_result(self, document, result):
+        """Запоминает инлайн-результат основного аккаунта для отправки нажатием"""
+        doc_id = getattr(document, 'id', None)
+        if doc_id is None:
+            return
+        self.inline_results.pop(doc_id, None)
+        self.inline_results[doc_id] = (time.time(), result)
+        while len(self.inline_results) > 300:
+            del self.inline_results[next(iter(self.inline_results))]
+
+    def _record_send(self, bot_username, strategy, latency, ok):
+        """Учитывает задержку и неудачи способа отправки для бота"""
+        stats = self.send_stats.setdefault(bot_username.lower(), {}).setdefault(
+            strategy,
+            {'sends': 0, 'failures': 0, 'latency': latency}
+        )
+        stats['sends'] += 1
+        if not ok:
+            stats['failures'] += 1
+        stats['latency'] = stats['latency'] * 0.8 + latency * 0.2
+
+    def _choose_send_strategy(self, bot_username):
+        """Выбирает отправку нажатием на инлайн-результат или send_file по ожидаемой задержке"""
+        stats = self.send_stats.get(bot_username.lower(), {})
+        click = stats.get('click')
+        file = stats.get('file')
+        if not click:
+            return 'click'
+        if not file or file['sends'] < 3:
+            # Пока нажатия удаются, send_file не измеряется - изредка отправляем файлом для сравнения
+            sends = click['sends'] + (file['sends'] if file else 0)
+            return 'file' if sends % 5 == 4 else 'click'
+        
+        failure_rate = (click['failures'] + 1) / (click['sends'] + 2)
+        # Неудачное нажатие дополнительно стоит обычной отправки файла
+        click_cost = click['latency'] + failure_rate * file['latency']
+        return 'click' if click_cost <= file['latency'] else 'file'
+
+    async def _click_with_topic(self, inline_result, to_id, reply_to_msg):
+        """Отправляет инлайн-результат от имени основного аккаунта с учетом темы"""
+        topic_id = self._get_topic_id(reply_to_msg)
+        if topic_id and self._is_forum_chat(reply_to_msg):
+            reply_to = topic_id
+        else:
+            reply_to = reply_to_msg.id
+        
+        # hide_via убирает "via @bot"; подпись и кнопки, приложенные ботом к результату, остаются
+        try:
+            return await inline_result.click(to_id, reply_to=reply_to, hide_via=True)
+        except Exception as e:
+            if "TOPIC_CLOSED" in str(e) or "TOPIC_DELETED" in str(e):
+                return await inline_result.click(to_id, hide_via=True)
+            raise e
+
+    def _remember_sent(self, track_id, to_id, sent):
+        """Запоминает последнее сообщение, в котором был отправлен трек"""
+        sent_id = getattr(sent, 'id', None)
+        if not sent_id:
+            return
+        self.sent_tracks.pop(track_id, None)
+        self.sent_tracks[track_id] = (to_id, sent_id)
+        while len(self.sent_tracks) > 500:
+            del self.sent_tracks[next(iter(self.sent_tracks))]
+
+    async def _forward_sent(self, track_id, to_id, reply_to_msg):
+        """Пересылает ранее отправленный трек одним запросом вместо новой отправки"""
+        delivered = self.sent_tracks.get(track_id)
+        if not delivered:
+            return None
+        # forward_messages не умеет отправлять в тему форума
+        if self._get_topic_id(reply_to_msg) and self._is_forum_chat(reply_to_msg):
+            return None
+        
+        from_peer, sent_id = delivered
+        try:
+            forwarded = await self.client.forward_messages(to_id, sent_id, from_peer, drop_author=True)
+        except TypeError:
+            # Без drop_author пересылка показала бы исходный чат и отправителя - отправляем обычным способом
+            return None
+        except Exception as e:
+            logger.debug(f"Не удалось переслать трек {track_id}, отправляем заново: {e}")
+            forwarded = None
+        
+        if isinstance(forwarded, list):
+            forwarded = forwarded[0] if forwarded else None
+        if not forwarded:
+            # Исходное сообщение удалено или недоступно
+            self.sent_tracks.pop(track_id, None)
+        return forwarded
+
     async def _send_with_reply(self, to_id, file, reply_to_msg):
+        """Отправляет трек пересылкой, нажатием на инлайн-результат или через send_file"""
+        track_id = self._get_track_id(file)
+        forwarded = await self._forward_sent(track_id, to_id, reply_to_msg)
+        if forwarded:
+            self._remember_sent(track_id, to_id, forwarded)
+            return forwarded
+        
+        sent = await self._deliver(to_id, file, reply_to_msg)
+        self._remember_sent(track_id, to_id, sent)
+        return sent
+
+    async def _deliver(self, to_id, file, reply_to_msg):
+        """Отправляет трек нажатием на инлайн-результат или через send_file"""
+        doc_id = getattr(file, 'id', None)
+        ref = self.doc_refs.get(doc_id)
+        bot_username = ref['bot'] if ref else None
+        
+        stored = self.inline_results.get(doc_id)
+        if stored and time.time() - stored[0] >= 300:
+            del self.inline_results[doc_id]
+            stored = None
+        
+        if stored and bot_username and self._choose_send_strategy(bot_username) == 'click':
+            started = time.time()
+            try:
+                sent = await self._click_with_topic(stored[1], to_id, reply_to_msg)
+                self._record_send(bot_username, 'click', time.time() - started, True)
+                return sent
+            except Exception as e:
+                self._record_send(bot_username, 'click', time.time() - started, False)
+                self.inline_results.pop(doc_id, None)
+                logger.debug(f"Отправка нажатием через {bot_username} не удалась, используем send_file: {e}")
+        
+        started = time.time()
+        try:
+            sent = await self._send_file_with_refresh(to_id, file, reply_to_msg)
+        except Exception:
+            if bot_username:
+                self._record_send(bot_username, 'file', time.time() - started, False)
+            raise
+        if bot_username:
+            self._record_send(bot_username, 'file', time.time() - started, True)
+        return sent
+
+    async def _send_file_with_refresh(self, to_id, file, reply_to_msg):
+        """Отправляет файл с учетом темы и обновлением устаревшего file_reference"""
+        try:
+            return await self._send_with_topic(to_id, file, reply_to_msg)
+        except Exception as e:
+            expired = isinstance(e, FileReferenceExpiredError) or "FILE_REFERENCE_EXPIRED" in str(e)
+            # Документ, найденный дополнительным аккаунтом, перезапрашивается основным
+            ref = self.doc_refs.get(getattr(file, 'id', None))
+            if not expired and not (ref and not ref.get('primary', True)):
+                raise e
+            
+            fresh_document = await self._refresh_document(file)
+            if not fresh_document:
+                raise e
+            
+            return await self._send_with_topic(to_id, fresh_document, reply_to_msg)
+
+    async def _send_with_topic(self, to_id, file, reply_to_msg):
         """Отправляет файл с учетом темы"""
         try:
             topic_id = self._get_topic_id(reply_to_msg)
@@ -320,7 +1208,14 @@ class SheoMusMod(loader.Module):
             raise e
 
     def is_bot_failed(self, bot_username):
-        """Проверяет, не заблокирован ли бот для инлайн-режима"""
+        """Проверяет, не заблокирован ли бот для инлайн-режима и найден ли он"""
+        unresolved = self.unresolved_bots.get(bot_username.lower())
+        if unresolved:
+            if time.time() - unresolved[0] < 600:
+                return True
+            # Даем боту новую попытку: при следующем поиске username разрешится заново
+            del self.unresolved_bots[bot_username.lower()]
+        
         if bot_username in self.failed_bots:
             fail_time = self.failed_bots[bot_username]
             if time.time() - fail_time < 3600:
@@ -333,23 +1228,207 @@ class SheoMusMod(loader.Module):
         """Помечает бота как недоступного для инлайн-режима на час"""
         self.failed_bots[bot_username] = time.time()
 
-    async def search_in_bot(self, bot_username, query, message):
+    def _record_bot_query(self, bot_username, latency, result_count, query=None, outcome="ok"):
+        """Учитывает запрос к боту: число запросов, результатов и задержку"""
+        trace = _current_trace.get()
+        if trace:
+            trace.span(
+                'bot_query',
+                bot=bot_username,
+                variation=query,
+                latency_ms=int(latency * 1000),
+                outcome="empty" if outcome == "ok" and not result_count else outcome,
+                results=result_count
+            )
+        
+        stats = self.bot_stats.setdefault(
+            bot_username.lower(),
+            {'queries': 0, 'hits': 0, 'empty': 0, 'latency': latency}
+        )
+        stats['queries'] += 1
+        if not result_count:
+            stats['empty'] += 1
+        stats['latency'] = stats['latency'] * 0.8 + latency * 0.2
+
+    def _record_cached_query(self, bot_username, music_results):
+        """Учитывает ответ бота из кэша как запрос, не меняя оценку задержки"""
+        stats = self.bot_stats.get(bot_username.lower())
+        if stats:
+            stats['queries'] += 1
+            if not music_results:
+                stats['empty'] += 1
+        for result in music_results:
+            ref = self.doc_refs.get(getattr(result['document'], 'id', None))
+            if ref:
+                ref['hit_pending'] = True
+
+    def _record_bot_hit(self, document):
+        """Учитывает, что отправлен документ, найденный ботом (не чаще раза на ответ бота)"""
+        ref = self.doc_refs.get(getattr(document, 'id', None))
+        if ref and ref.pop('hit_pending', False) and ref['bot'].lower() in self.bot_stats:
+            self.bot_stats[ref['bot'].lower()]['hits'] += 1
+
+    def _bot_hit_rate(self, bot_username):
+        """Сглаженная доля запросов к боту, результат которых был отправлен"""
+        stats = self.bot_stats.get(bot_username.lower())
+        if not stats:
+            return 0.5
+        return min((stats['hits'] + 1) / (stats['queries'] + 2), 1.0)
+
+    def _plan_bot_waves(self, bots):
+        """Делит ботов на первую волну (top-k по попаданиям и задержке) и остальных"""
+        def priority(bot):
+            stats = self.bot_stats.get(bot.lower(), {})
+            latency = max(stats.get('latency', 1.0), 0.3)
+            return (self._bot_hit_rate(bot) + self._bot_pick_rate(bot)) / latency
+        
+        ordered = sorted(bots, key=priority, reverse=True)
+        wave_size = self.config["bot_wave_size"]
+        return [ordered[:wave_size], ordered[wave_size:]]
+
+    def add_search_client(self, client, rate=None):
+        """Добавляет дополнительный аккаунт для инлайн-запросов (любой объект с inline_query)"""
+        for search_client in self.search_clients:
+            if search_client.client is client:
+                return search_client
+        search_client = SearchClient(client, rate or self.config["search_client_rate"])
+        self.search_clients.append(search_client)
+        return search_client
+
+    def remove_search_client(self, client):
+        """Убирает дополнительный аккаунт из пула"""
+        self.search_clients = [c for c in self.search_clients if c.client is not client]
+
+    def _pick_search_client(self, message):
+        """Выбирает аккаунт с наибольшим остатком бюджета и без FloodWait (None - таких нет)"""
+        primary = self._primary_search_client
+        if not primary or primary.client is not message.client:
+            primary = SearchClient(message.client, self.config["search_client_rate"])
+            self._primary_search_client = primary
+        
+        pool = [primary] + self.search_clients
+        available = [c for c in pool if c.budget() >= 1]
+        if not available:
+            # Запрос сейчас был бы отклонен FloodWait - не отправляем его
+            return None
+        return max(available, key=lambda c: c.budget())
+
+    def _store_raw_results(self, cache_key, music_results, next_offset):
+        """Кэширует разобранный ответ бота на запрос"""
+        self.raw_cache.pop(cache_key, None)
+        self.raw_cache[cache_key] = (time.time(), list(music_results), next_offset)
+        while len(self.raw_cache) > 300:
+            del self.raw_cache[next(iter(self.raw_cache))]
+
+    async def search_in_history(self, query, message, timeout):
+        """Ищет трек среди аудио текущего чата и Избранного серверным поиском"""
+        if timeout <= 0:
+            return None
+        
+        async def search_peer(peer):
+            found = []
+            async for history_message in message.client.iter_messages(
+                peer,
+                search=query,
+                filter=InputMessagesFilterMusic,
+                limit=self.config["history_limit"]
+            ):
+                if getattr(history_message, 'document', None):
+                    found.append(history_message)
+            return found
+        
+        peers = [message.peer_id, "me"]
+        tasks = [asyncio.ensure_future(search_peer(peer)) for peer in peers]
+        started = time.time()
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        
+        best_message = None
+        best_score = 0
+        for task in tasks:
+            if task not in done or task.cancelled() or task.exception():
+                continue
+            for history_message in task.result():
+                track_info = self.extract_track_info_from_document(history_message.document, '')
+                score = self.calculate_relevance_score(track_info, query)
+                if score > best_score:
+                    best_message = history_message
+                    best_score = score
+        
+        trace = _current_trace.get()
+        if trace:
+            trace.span(
+                'history_search',
+                latency_ms=int((time.time() - started) * 1000),
+                timed_out=len(pending),
+                score=best_score
+            )
+        
+        if not best_message or best_score < 20:
+            return None
+        
+        # Найденное сообщение уже есть в чате: отправка сведется к пересылке
+        document = best_message.document
+        self._remember_sent(self._get_track_id(document), best_message.peer_id, best_message)
+        return document
+
+    async def search_in_bot(self, bot_username, query, message, timeout=3.0):
         """Улучшенный поиск в одном боте с получением нескольких результатов"""
-        if self.is_bot_failed(bot_username):
-            return []
-            
+        results, _ = await self.search_in_bot_page(bot_username, query, message, timeout=timeout)
+        return results
+
+    async def search_in_bot_page(self, bot_username, query, message, offset=None, timeout=3.0):
+        """Получает страницу результатов бота и смещение следующей страницы"""
+        if self.is_bot_failed(bot_username) or timeout <= 0:
+            return [], None
+        
+        cache_key = (bot_username.lower(), self._normalize_query(query), offset or None)
+        counters = self.raw_cache_stats.setdefault(cache_key[0], [0, 0])
+        cached = self.raw_cache.get(cache_key)
+        if cached and time.time() - cached[0] < self.config["raw_cache_ttl"]:
+            counters[0] += 1
+            trace = _current_trace.get()
+            if trace:
+                trace.span('bot_query', bot=bot_username, variation=query, outcome="cache", results=len(cached[1]))
+            self._capture_answer(bot_username, query, offset, 0, "cache", cached[1])
+            self._record_cached_query(bot_username, cached[1])
+            return list(cached[1]), cached[2]
+        counters[1] += 1
+        
+        search_client = self._pick_search_client(message)
+        if not search_client:
+            logger.debug(f"Нет аккаунта с бюджетом запросов, пропускаем бота {bot_username}")
+            self.budget_skips += 1
+            trace = _current_trace.get()
+            if trace:
+                trace.span('bot_query', bot=bot_username, variation=query, outcome="no_budget", results=0)
+            self._capture_answer(bot_username, query, offset, 0, "no_budget")
+            return [], None
+        search_client.take()
+        is_primary = search_client is self._primary_search_client
+        # Сохраненные peer принадлежат основному аккаунту
+        bot = self._bot_peer(bot_username) if is_primary else bot_username
+        
+        started = time.time()
         try:
             results = await asyncio.wait_for(
-                message.client.inline_query(bot_username, query),
-                timeout=3.0
+                search_client.client.inline_query(bot, query, offset=offset),
+                timeout=timeout
             )
             
             if not results or not hasattr(results, '__iter__'):
-                return []
+                self._record_bot_query(bot_username, time.time() - started, 0, query)
+                self._capture_answer(bot_username, query, offset, time.time() - started, "ok")
+                self._store_raw_results(cache_key, [], None)
+                return [], None
+            
+            next_offset = getattr(results, 'next_offset', None) or None
             
             music_results = []
             
-            for i in range(min(len(results), 10)):
+            # Разбираем всю страницу: следующая страница бота начинается после ее последнего результата
+            for i in range(len(results)):
                 result = results[i]
                 if hasattr(result.result, 'document') and result.result.document:
                     try:
@@ -367,6 +1446,10 @@ class SheoMusMod(loader.Module):
                         if not title and hasattr(result.result, 'title'):
                             title = result.result.title
                         
+                        self._remember_document(doc, bot_username, query, i, is_primary, offset)
+                        if is_primary:
+                            self._remember_inline_result(doc, result)
+                        
                         music_results.append({
                             'bot': bot_username,
                             'document': doc,
@@ -380,20 +1463,38 @@ class SheoMusMod(loader.Module):
                         logger.error(f"Ошибка обработки результата от {bot_username}: {e}")
                         continue
             
-            return music_results
+            self._record_bot_query(bot_username, time.time() - started, len(music_results), query)
+            self._capture_answer(bot_username, query, offset, time.time() - started, "ok", music_results)
+            self._store_raw_results(cache_key, music_results, next_offset)
+            return music_results, next_offset
             
         except asyncio.TimeoutError:
-            return []
+            self._record_bot_query(bot_username, time.time() - started, 0, query, "timeout")
+            self._capture_answer(bot_username, query, offset, time.time() - started, "timeout")
+            return [], None
         except Exception as e:
+            self._record_bot_query(bot_username, time.time() - started, 0, query, "error")
+            self._capture_answer(bot_username, query, offset, time.time() - started, "error")
             error_str = str(e)
             if "can't be used in inline mode" in error_str or "bot can't be used" in error_str.lower():
                 logger.warning(f"Бот {bot_username} не поддерживает инлайн-режим, временно исключен")
                 self.mark_bot_failed(bot_username)
             elif "wait" in error_str.lower() and "second" in error_str.lower():
                 logger.debug(f"Бот {bot_username} требует ожидания")
+                search_client.flood(getattr(e, 'seconds', None) or 30)
+            elif is_primary and (
+                "PEER_ID_INVALID" in error_str
+                or "USERNAME_" in error_str
+                or "input entity" in error_str
+                or "No user has" in error_str
+                or "any entity" in error_str
+            ):
+                logger.warning(f"Peer бота {bot_username} недействителен, разрешаем заново")
+                self.bot_peers.pop(bot_username.lower(), None)
+                self._schedule_resolve([bot_username])
             else:
                 logger.error(f"Ошибка поиска в боте {bot_username}: {e}")
-            return []
+            return [], None
 
     def clean_query(self, query):
         """Очищает запрос от лишних символов"""
@@ -505,8 +1606,71 @@ class SheoMusMod(loader.Module):
             'raw_title': raw_title
         }
 
-    async def search_music_all_bots(self, query, message):
-        """Улучшенный поиск по всем ботам с приоритетом названия"""
+    def _bot_pick_rate(self, bot_username):
+        """Доля показов меню, в которых пользователь выбрал трек этого бота"""
+        offers, picks = self.pick_stats['bots'].get(bot_username.lower(), (0, 0))
+        if offers < 5:
+            return 0
+        return min(picks / offers, 1.0)
+
+    def _pick_boost(self, bot_username, query):
+        """Бонус к релевантности по истории выборов пользователей"""
+        boost = 10 * self._bot_pick_rate(bot_username)
+        
+        query_picks = self.pick_stats['queries'].get(self._normalize_query(query))
+        if query_picks:
+            boost += 20 * query_picks.get(bot_username.lower(), 0) / sum(query_picks.values())
+        
+        return int(boost)
+
+    def _score_track(self, track_info, query):
+        """Оценивает трек: релевантность для порогов и релевантность с бонусом выборов для порядка"""
+        score = self.calculate_relevance_score(track_info, query)
+        # История выборов только упорядочивает подходящие треки, но не делает подходящим нерелевантный
+        if score <= 0:
+            return score, score
+        return score, score + self._pick_boost(track_info['bot'], query)
+
+    def _order_bots_by_picks(self, bots):
+        """Сортирует ботов по частоте выбора их результатов"""
+        return sorted(bots, key=self._bot_pick_rate, reverse=True)
+
+    def record_offer(self, bots):
+        """Учитывает показ меню с результатами указанных ботов"""
+        for bot in {b.lower() for b in bots if b}:
+            offers, picks = self.pick_stats['bots'].get(bot, (0, 0))
+            self.pick_stats['bots'][bot] = [offers + 1, picks]
+
+    def record_pick(self, bot_username, query):
+        """Учитывает выбор пользователем трека бота по запросу"""
+        if not bot_username:
+            return
+        bot = bot_username.lower()
+        
+        offers, picks = self.pick_stats['bots'].get(bot, (0, 0))
+        self.pick_stats['bots'][bot] = [max(offers, picks + 1), picks + 1]
+        
+        if query:
+            queries = self.pick_stats['queries']
+            query_key = self._normalize_query(query)
+            query_picks = queries.pop(query_key, {})
+            query_picks[bot] = query_picks.get(bot, 0) + 1
+            queries[query_key] = query_picks
+            while len(queries) > 500:
+                del queries[next(iter(queries))]
+
+    def _time_left(self, deadline, cap):
+        """Время на этап: не больше cap и не позже общего дедлайна поиска"""
+        if deadline is None:
+            return cap
+        return max(0.0, min(cap, deadline - time.time()))
+
+    async def search_music_all_bots(self, query, message, deadline=None):
+        """Улучшенный поиск по всем ботам с приоритетом названия
+
+        deadline - абсолютное время (time.time()), к которому поиск должен завершиться;
+        по его истечении возвращается лучший найденный результат.
+        """
         if not query:
             return None
             
@@ -521,14 +1685,26 @@ class SheoMusMod(loader.Module):
             words = cleaned_query.split()
             search_variations.append(' '.join(words[:-1]))
         
+        if self.config["history_search"]:
+            document = await self.search_in_history(
+                cleaned_query, message, self._time_left(deadline, self.config["history_timeout"])
+            )
+            if document:
+                self._trace_early_exit('history', None, None)
+                return document
+        
         # Приоритетный бот - Lybot
         priority_bot = "Lybot"
         priority_results = []
+        all_results = []
         
         if not self.is_bot_failed(priority_bot):
             try:
-                results = await self.search_in_bot(priority_bot, cleaned_query, message)
+                results = await self.search_in_bot(
+                    priority_bot, cleaned_query, message, self._time_left(deadline, 3.0)
+                )
                 if results:
+                    all_results.extend(results)
                     for result in results:
                         if result and result.get('document'):
                             track_info = self.extract_track_info_from_document(
@@ -550,67 +1726,83 @@ class SheoMusMod(loader.Module):
             for track_info in priority_results:
                 score = self.calculate_relevance_score(track_info, cleaned_query)
                 if score >= 20:
+                    self._trace_early_exit('priority', priority_bot, score)
                     return track_info['document']
         
-        # Поиск по всем остальным ботам
+        # Поиск по остальным ботам: сначала лучшие по истории, остальные - если их не хватило
         inline_bots = [bot for bot in self.music_bots if bot != priority_bot and not self.is_bot_failed(bot)]
-        all_results = []
+        bot_waves = [wave for wave in self._plan_bot_waves(inline_bots) if wave]
         
         for search_query in search_variations:
             if not search_query:
                 continue
                 
-            search_tasks = []
-            for bot_username in inline_bots:
-                task = asyncio.create_task(self.search_in_bot(bot_username, search_query, message))
-                search_tasks.append(task)
+            for wave_bots in bot_waves:
+                if self._time_left(deadline, 1.0) <= 0:
+                    break
+                
+                search_tasks = []
+                for bot_username in wave_bots:
+                    task = asyncio.create_task(self.search_in_bot(
+                        bot_username, search_query, message, self._time_left(deadline, 3.0)
+                    ))
+                    search_tasks.append(task)
             
-            start_time = time.time()
-            timeout = 8.0
+                wave_deadline = time.time() + self._time_left(deadline, 8.0)
             
-            while time.time() - start_time < timeout and search_tasks:
-                completed = [t for t in search_tasks if t.done()]
+                while time.time() < wave_deadline and search_tasks:
+                    completed, _ = await asyncio.wait(
+                        search_tasks,
+                        timeout=wave_deadline - time.time(),
+                        return_when=asyncio.FIRST_COMPLETED
+                    )
                 
-                for task in completed:
-                    search_tasks.remove(task)
+                    for task in completed:
+                        search_tasks.remove(task)
                         
-                    try:
-                        results = task.result()
-                        if isinstance(results, list) and results:
-                            all_results.extend(results)
+                        try:
+                            results = task.result()
+                            if isinstance(results, list) and results:
+                                all_results.extend(results)
                             
-                            scored_results = []
-                            for result in results:
-                                if not result or not result.get('document'):
-                                    continue
+                                scored_results = []
+                                for result in results:
+                                    if not result or not result.get('document'):
+                                        continue
                                 
-                                track_info = self.extract_track_info_from_document(
-                                    result['document'], 
-                                    result.get('raw_title', '')
-                                )
+                                    track_info = self.extract_track_info_from_document(
+                                        result['document'], 
+                                        result.get('raw_title', '')
+                                    )
                                 
-                                track_info.update({
-                                    'bot': result.get('bot', ''),
-                                    'document': result['document'],
-                                    'result_id': result.get('result_id', 0),
-                                    'original_result': result.get('original_result')
-                                })
+                                    track_info.update({
+                                        'bot': result.get('bot', ''),
+                                        'document': result['document'],
+                                        'result_id': result.get('result_id', 0),
+                                        'original_result': result.get('original_result')
+                                    })
                                 
-                                score = self.calculate_relevance_score(track_info, cleaned_query)
-                                scored_results.append((score, track_info))
+                                    score, ranked = self._score_track(track_info, cleaned_query)
+                                    if score >= 20:
+                                        scored_results.append((ranked, track_info))
                             
-                            if scored_results:
-                                scored_results.sort(key=lambda x: x[0], reverse=True)
-                                best_score, best_result = scored_results[0]
-                                
-                                if best_score >= 20:
+                                if scored_results:
+                                    scored_results.sort(key=lambda x: x[0], reverse=True)
+                                    best_score, best_result = scored_results[0]
+                                    self._trace_early_exit('wave', best_result['bot'], best_score)
                                     return best_result['document']
                         
-                    except Exception as e:
-                        logger.error(f"Ошибка обработки результатов: {e}")
+                        except Exception as e:
+                            logger.error(f"Ошибка обработки результатов: {e}")
                 
-                if search_tasks:
-                    await asyncio.sleep(0.2)
+                # Не дождавшиеся дедлайна волны запросы больше не нужны
+                for task in search_tasks:
+                    task.cancel()
+        
+        # По истечении бюджета отдаем лучший результат не ниже deadline_min_score
+        min_score = 10
+        if deadline is not None and time.time() >= deadline:
+            min_score = self.config["deadline_min_score"]
         
         if all_results:
             all_scored_results = []
@@ -630,24 +1822,283 @@ class SheoMusMod(loader.Module):
                     'original_result': result.get('original_result')
                 })
                 
-                score = self.calculate_relevance_score(track_info, cleaned_query)
-                all_scored_results.append((score, track_info))
+                score, ranked = self._score_track(track_info, cleaned_query)
+                if score >= min_score:
+                    all_scored_results.append((ranked, track_info))
             
             if all_scored_results:
                 all_scored_results.sort(key=lambda x: x[0], reverse=True)
                 best_score, best_result = all_scored_results[0]
-                if best_score >= 10:
-                    return best_result['document']
+                self._trace_early_exit('final', best_result['bot'], best_score)
+                return best_result['document']
         
+        self._trace_early_exit('not_found', None, None)
         return None
 
-    async def search_music(self, query, message, status_msg=None):
+    def _trace_early_exit(self, stage, bot_username, score):
+        """Отмечает в трассировке, на каком этапе и с какой оценкой завершился поиск"""
+        trace = _current_trace.get()
+        if trace:
+            trace.span('decision', stage=stage, bot=bot_username, score=score)
+
+    def _normalize_query(self, query):
+        """Нормализует запрос для использования в качестве ключа кэша"""
+        return self.clean_query(query).lower()
+
+    @contextlib.contextmanager
+    def _trace(self, kind, query):
+        """Открывает трассировку поиска, если она включена и еще не открыта выше"""
+        active = _current_trace.get()
+        if active or not self.config["trace_enabled"]:
+            yield active
+            return
+        
+        trace = SearchTrace(kind, query)
+        token = _current_trace.set(trace)
+        try:
+            yield trace
+        finally:
+            _current_trace.reset(token)
+            self._finish_trace(trace)
+
+    def _finish_trace(self, trace):
+        """Пишет трассировку в журнал медленных поисков, если превышен порог"""
+        if trace.duration_ms < self.config["slow_search_ms"]:
+            return
+        
+        try:
+            if not self._slow_log:
+                self._slow_log = self._jsonl_logger("slow", self.config["slow_log_path"])
+            self._slow_log.info(json.dumps(trace.to_dict(), ensure_ascii=False, default=str))
+        except Exception as e:
+            logger.error(f"Не удалось записать медленный поиск {trace.trace_id}: {e}")
+
+    def _jsonl_logger(self, name, path):
+        """Создает логгер, пишущий строки JSONL в файл с ротацией"""
+        jsonl_log = logging.getLogger(f"{__name__}.{name}")
+        jsonl_log.propagate = False
+        jsonl_log.setLevel(logging.INFO)
+        handler = logging.handlers.RotatingFileHandler(
+            path,
+            maxBytes=1024 * 1024,
+            backupCount=3,
+            encoding="utf-8"
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        jsonl_log.addHandler(handler)
+        return jsonl_log
+
+    def _capture_answer(self, bot_username, query, offset, latency, outcome, music_results=()):
+        """Добавляет ответ бота в запись текущего поиска, если запись включена"""
+        capture = _current_capture.get()
+        if capture is None:
+            return
+        capture['answers'].append({
+            'bot': bot_username,
+            'query': query,
+            'offset': offset or None,
+            'latency_ms': int(latency * 1000),
+            'outcome': outcome,
+            'results': [
+                {
+                    'doc_id': getattr(result['document'], 'id', None),
+                    'title': result.get('title', ''),
+                    'performer': result.get('performer', ''),
+                    'raw_title': result.get('raw_title', '')
+                }
+                for result in music_results
+            ]
+        })
+
+    async def _captured_search(self, query, message, deadline):
+        """Выполняет поиск по ботам и при включенной записи сохраняет его в журнал"""
+        if not self.config["capture_enabled"]:
+            return await self.search_music_all_bots(query, message, deadline)
+        
+        started = time.time()
+        capture = {
+            'ts': started,
+            'query': query,
+            'budget': round(deadline - started, 3) if deadline else None,
+            'answers': []
+        }
+        token = _current_capture.set(capture)
+        try:
+            found = await self.search_music_all_bots(query, message, deadline)
+        finally:
+            _current_capture.reset(token)
+        
+        ref = self.doc_refs.get(getattr(found, 'id', None))
+        capture['latency_ms'] = int((time.time() - started) * 1000)
+        capture['queries'] = sum(
+            1 for answer in capture['answers'] if answer['outcome'] not in ("cache", "no_budget")
+        )
+        capture['chosen'] = {'bot': ref['bot'], 'doc_id': ref['id']} if ref else None
+        
+        try:
+            if not self._capture_log:
+                self._capture_log = self._jsonl_logger("capture", self.config["capture_path"])
+            self._capture_log.info(json.dumps(capture, ensure_ascii=False, default=str))
+        except Exception as e:
+            logger.error(f"Не удалось записать поиск в журнал: {e}")
+        
+        return found
+
+    def _read_capture(self, path, limit):
+        """Читает последние записи журнала поиска"""
+        records = collections.deque(maxlen=limit)
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+        return list(records)
+
+    def _replay_snapshot(self):
+        """Снимает копию настроек и статистики для воспроизведения вне основного цикла событий"""
+        config = {key: self.config[key] for key in self.config}
+        config.update(capture_enabled=False, trace_enabled=False, history_search=False)
+        return {
+            'config': config,
+            'music_bots': list(self.music_bots),
+            'pick_stats': copy.deepcopy(self.pick_stats),
+            'bot_stats': copy.deepcopy(self.bot_stats)
+        }
+
+    def _run_replay(self, records, snapshot):
+        """Воспроизводит записи по одной в отдельном цикле событий, изолированно от живого трафика"""
+        async def run():
+            outcomes = []
+            for record in records:
+                try:
+                    outcomes.append(await self._replay_record(record, snapshot))
+                except Exception as e:
+                    logger.error(f"Ошибка воспроизведения запроса '{record.get('query')}': {e}")
+            return outcomes
+        
+        return asyncio.run(run())
+
+    async def _replay_record(self, record, snapshot):
+        """Воспроизводит записанный поиск на изолированном экземпляре с текущими настройками"""
+        replay = SheoMusMod()
+        for key, value in snapshot['config'].items():
+            replay.config[key] = value
+        
+        replay.database = ReplayDatabase()
+        replay.database.set("SheoMus", "music_bots", snapshot['music_bots'])
+        replay.settings = SettingsSnapshot(replay.database)
+        replay.pick_stats = copy.deepcopy(snapshot['pick_stats'])
+        replay.bot_stats = copy.deepcopy(snapshot['bot_stats'])
+        
+        client = ReplayClient(record['answers'])
+        replay_message = types.SimpleNamespace(client=client, chat_id=None)
+        
+        started = time.time()
+        deadline = started + record['budget'] if record.get('budget') else None
+        result = await replay.search_music_all_bots(record['query'], replay_message, deadline)
+        chosen = record.get('chosen')
+        return {
+            'record': record,
+            'agree': (getattr(result, 'id', None) == chosen['doc_id']) if chosen else result is None,
+            'latency_ms': int((time.time() - started) * 1000),
+            'queries': client.queries,
+            'missing': client.missing
+        }
+
+    def _deadline(self, budget):
+        """Переводит бюджет в секундах в абсолютный дедлайн (0 - без ограничения)"""
+        if not budget:
+            return None
+        return time.time() + budget
+
+    async def search_music(self, query, message, status_msg=None, deadline=None):
         """Основной метод поиска"""
         if not query:
             return None
-        async with self.search_lock:
-            result = await self.search_music_all_bots(query, message)
-            return result
+        
+        with self._trace("search_music", query):
+            return await self._search_music(query, message, deadline)
+
+    async def _search_music(self, query, message, deadline):
+        """Поиск с учетом кэша найденных и ненайденных запросов"""
+        trace = _current_trace.get()
+        cache_key = self._normalize_query(query)
+        cached = self.cache.get(cache_key)
+        if cached and time.time() - cached['time'] < 21600:
+            document = self._input_document(cached['doc_id'])
+            if document:
+                if trace:
+                    trace.span('cache_hit', doc_id=cached['doc_id'])
+                return document
+        
+        failed_at = self.negative_cache.get(cache_key)
+        if failed_at and time.time() - failed_at < self.config["negative_cache_ttl"]:
+            if trace:
+                trace.span('negative_cache_hit')
+            return None
+        
+        # Хранилище в памяти процесса не знает результатов, которых нет в self.cache
+        if self.cache_backend and self.cache_backend.shared:
+            shared = await self._fetch_shared("results", [cache_key])
+            if cache_key in shared:
+                ref = self._import_ref(shared[cache_key])
+                self.cache[cache_key] = {'doc_id': ref['id'], 'time': time.time()}
+                if trace:
+                    trace.span('shared_cache_hit', doc_id=ref['id'])
+                return self._input_document(ref['id'])
+        
+        # Одинаковые запросы, пришедшие одновременно, ждут один общий поиск,
+        # разные запросы ищутся параллельно
+        inflight = self.inflight_searches.get(cache_key)
+        if inflight is None:
+            inflight = asyncio.ensure_future(self._search_and_remember(query, message, deadline, cache_key))
+            self.inflight_searches[cache_key] = inflight
+            inflight.add_done_callback(lambda _: self.inflight_searches.pop(cache_key, None))
+        elif trace:
+            trace.span('joined_inflight')
+        
+        if deadline is None:
+            return await asyncio.shield(inflight)
+        # Общий поиск мог начаться с другим дедлайном: ждем его не дольше своего
+        try:
+            return await asyncio.wait_for(asyncio.shield(inflight), max(deadline - time.time(), 0))
+        except asyncio.TimeoutError:
+            if trace:
+                trace.span('deadline_exceeded')
+            return None
+
+    async def _search_and_remember(self, query, message, deadline, cache_key):
+        """Ищет трек по ботам и сохраняет результат в кэш найденных или ненайденных запросов"""
+        budget_skips = self.budget_skips
+        result = await self._captured_search(query, message, deadline)
+        # Пропущенные из-за бюджета боты тоже не доказывают, что трека нет
+        cut_short = self.budget_skips != budget_skips or (deadline is not None and time.time() >= deadline)
+        
+        if result is None:
+            # Поиск, прерванный дедлайном, не доказывает, что трека нет
+            if cut_short:
+                return None
+            self.negative_cache.pop(cache_key, None)
+            self.negative_cache[cache_key] = time.time()
+            while len(self.negative_cache) > 500:
+                del self.negative_cache[next(iter(self.negative_cache))]
+            return None
+        
+        self.negative_cache.pop(cache_key, None)
+        doc_id = getattr(result, 'id', None)
+        if doc_id in self.doc_refs:
+            self.cache.pop(cache_key, None)
+            self.cache[cache_key] = {'doc_id': doc_id, 'time': time.time()}
+            while len(self.cache) > 500:
+                del self.cache[next(iter(self.cache))]
+            
+            exported = self._export_ref(self.doc_refs[doc_id])
+            if self.cache_backend and self.cache_backend.shared:
+                self._publish("results", {cache_key: exported}, 21600)
+            self._publish("doc_refs", {str(doc_id): exported}, 86400)
+        
+        return result
 
     def _filter_duplicate_tracks(self, tracks):
         """Фильтрует дубликаты треков по названию и исполнителю"""
@@ -684,26 +2135,53 @@ class SheoMusMod(loader.Module):
             if not is_duplicate:
                 seen_keys.add(key)
                 unique_tracks.append(track)
-            
-            if len(unique_tracks) >= 10:
-                break
         
         return unique_tracks
 
-    async def search_music_inline(self, query, message, offset=0):
-        """Поиск музыки для инлайн-режима с возвратом нескольких результатов (без приоритета Lybot)"""
+    async def search_music_inline(self, query, message, offset=0, page_state=None, deadline=None):
+        """Поиск музыки для инлайн-режима с возвратом нескольких результатов (без приоритета Lybot)
+
+        offset - номер страницы; для offset > 0 нужен page_state первой страницы,
+        в который записываются смещения следующих страниц каждого бота.
+        """
         if not query:
             return []
-            
+        
+        if offset and not page_state:
+            return []
+        
+        with self._trace("search_music_inline", query):
+            return await self._search_music_inline(query, message, offset, page_state, deadline)
+
+    async def _search_music_inline(self, query, message, offset, page_state, deadline):
+        """Опрашивает ботов и возвращает отсортированные уникальные треки"""
         cleaned_query = self.clean_query(query)
         
-        # Получаем все боты, включая Lybot, но без приоритета
-        all_bots = [bot for bot in self.music_bots if not self.is_bot_failed(bot)]
+        if offset:
+            # Следующая страница - только у ботов, у которых она есть
+            all_bots = [
+                bot for bot, next_offset in page_state['offsets'].items()
+                if next_offset and not self.is_bot_failed(bot)
+            ]
+        else:
+            # Получаем все боты, включая Lybot; чаще выбираемые опрашиваются первыми
+            all_bots = self._order_bots_by_picks(
+                [bot for bot in self.music_bots if not self.is_bot_failed(bot)]
+            )
         all_scored_results = []
         
         for bot_username in all_bots:
+            timeout = self._time_left(deadline, 3.0)
+            if timeout <= 0:
+                break
+            
             try:
-                results = await self.search_in_bot(bot_username, cleaned_query, message)
+                bot_offset = page_state['offsets'].get(bot_username) if offset else None
+                results, next_offset = await self.search_in_bot_page(
+                    bot_username, cleaned_query, message, bot_offset, timeout
+                )
+                if page_state is not None:
+                    page_state['offsets'][bot_username] = next_offset
                 
                 if not results:
                     continue
@@ -724,14 +2202,8 @@ class SheoMusMod(loader.Module):
                         'original_result': result.get('original_result')
                     })
                     
-                    score = self.calculate_relevance_score(track_info, cleaned_query)
-                    
-                    # Предпочитаемые боты (без Lybot)
-                    preferred_bots = ["vkmusic_bot", "tgmusicbot", "spotifydownloader_bot", "auddbot"]
-                    if bot_username in preferred_bots:
-                        score += 10
-                    
-                    all_scored_results.append((score, track_info))
+                    _, ranked = self._score_track(track_info, cleaned_query)
+                    all_scored_results.append((ranked, track_info))
                     
             except Exception as e:
                 logger.error(f"Ошибка при поиске в {bot_username}: {e}")
@@ -743,43 +2215,63 @@ class SheoMusMod(loader.Module):
         all_scored_results.sort(key=lambda x: x[0], reverse=True)
         all_tracks = [track_info for score, track_info in all_scored_results]
         
-        return self._filter_duplicate_tracks(all_tracks[:20])
+        trace = _current_trace.get()
+        if trace:
+            trace.span(
+                'score',
+                candidates=len(all_scored_results),
+                best_score=all_scored_results[0][0],
+                best_bot=all_tracks[0]['bot']
+            )
+        
+        return self._filter_duplicate_tracks(all_tracks)
 
-    async def _execute_search_and_send(self, message, search_query):
+    async def _execute_search_and_send(self, message, search_query, delete_early=False, budget=None):
         """Общая логика поиска и отправки музыки"""
         if not search_query:
             return
-            
+        
+        deadline = self._deadline(budget)
+        
+        # Сообщения поиска удаляются одним запросом в конце;
+        # delete_early убирает команду сразу, отдельным запросом
         searching_message = None
+        cleanup = []
         try:
-            await self._safe_delete(message)
+            if delete_early:
+                await self._safe_delete(message)
+            else:
+                cleanup.append(message)
             
             if self.emojis_enabled:
                 searching_message = await self._safe_respond(message, self.clock_emoji())
+                if searching_message:
+                    cleanup.append(searching_message)
 
-            music_document = await self.search_music(search_query, message, searching_message)
-
-            if searching_message:
-                await self._safe_delete(searching_message)
+            with self._trace("search_and_send", search_query) as trace:
+                music_document = await self.search_music(search_query, message, searching_message, deadline)
 
-            if not music_document:
-                error_message = await self._safe_respond(message, "Музыка не найдена")
-                await self.delete_after(error_message, 3)
-                return
+                if not music_document:
+                    error_message = await self._safe_respond(message, "Музыка не найдена")
+                    self.schedule_delete(error_message, 3)
+                    return
 
-            await self._send_with_reply(
-                message.to_id,
-                music_document,
-                message
-            )
+                send_started = time.time()
+                await self._send_with_reply(
+                    message.to_id,
+                    music_document,
+                    message
+                )
+                self._record_bot_hit(music_document)
+                if trace:
+                    trace.span('send', latency_ms=int((time.time() - send_started) * 1000))
 
         except Exception as error:
             logger.error(f"Ошибка в _execute_search_and_send: {error}")
-            await self._safe_delete(message)
-            if searching_message:
-                await self._safe_delete(searching_message)
             error_message = await self._safe_respond(message, f"Ошибка: {str(error)}")
-            await self.delete_after(error_message, 3)
+            self.schedule_delete(error_message, 3)
+        finally:
+            await self._delete_messages(cleanup)
 
     @loader.command(
         ru_doc="<название> - Ищет музыку по названию (работает с префиксом)",
@@ -792,7 +2284,7 @@ class SheoMusMod(loader.Module):
         if not self.check_spam(user_id):
             await self._safe_delete(message)
             error_message = await self._safe_respond(message, "Слишком много запросов! Подождите 5 секунд.")
-            await self.delete_after(error_message, 3)
+            self.schedule_delete(error_message, 3)
             return
         
         search_query = utils.get_args_raw(message)
@@ -800,10 +2292,10 @@ class SheoMusMod(loader.Module):
         if not search_query:
             await self._safe_delete(message)
             error_message = await self._safe_respond(message, "Укажите название песни!")
-            await self.delete_after(error_message, 3)
+            self.schedule_delete(error_message, 3)
             return
 
-        await self._execute_search_and_send(message, search_query)
+        await self._execute_search_and_send(message, search_query, budget=self.config["deadline_m"])
 
     @loader.command(
         ru_doc="<название> - Инлайн-поиск музыки (работает через инлайн)",
@@ -847,18 +2339,69 @@ class SheoMusMod(loader.Module):
             else:
                 await self._safe_respond(message, error_text)
 
-    async def _build_music_buttons(self, query: str, message: Message):
+    def _get_page_state(self, page_token):
+        """Возвращает состояние страниц меню, если оно еще не устарело"""
+        state = self.page_states.get(page_token)
+        if state and time.time() - state['time'] < 600:
+            return state
+        self.page_states.pop(page_token, None)
+        return None
+
+    def _new_page_state(self, query):
+        """Создает состояние страниц меню для запроса"""
+        page_token = uuid.uuid4().hex[:12]
+        state = {
+            'time': time.time(),
+            'query': query,
+            'page': 0,
+            'shown': 0,
+            'seen': set(),
+            'offsets': {},
+            'pending': []
+        }
+        self.page_states[page_token] = state
+        while len(self.page_states) > 100:
+            del self.page_states[next(iter(self.page_states))]
+        return page_token, state
+
+    async def _build_music_buttons(self, query: str, message: Message, page_token=None):
         """Создает кнопки с результатами поиска"""
         if not query:
             return [[{"text": "Пустой запрос", "action": "close"}]]
         
-        results = await self.search_music_inline(query, message)
+        state = self._get_page_state(page_token) if page_token else None
+        if not state:
+            page_token, state = self._new_page_state(query)
         
-        if not results:
+        if state['pending']:
+            # Сначала показываем уже полученные, но не показанные треки
+            results = state['pending']
+        else:
+            results = await self.search_music_inline(
+                query,
+                message,
+                state['page'],
+                state,
+                self._deadline(self.config["deadline_menu"])
+            )
+            state['page'] += 1
+        state['time'] = time.time()
+        
+        results = [
+            result for result in results
+            if getattr(result.get('document'), 'id', None) not in state['seen']
+        ]
+        state['pending'] = results[10:]
+        has_more = bool(state['pending']) or any(state['offsets'].values())
+        
+        if not results and not has_more:
             return [[{"text": "Ничего не найдено", "action": "close"}]]
         
+        self.record_offer(result.get('bot', '') for result in results[:10])
+        
         buttons = []
-        for i, result in enumerate(results[:10], 1):
+        for i, result in enumerate(results[:10], state['shown'] + 1):
+            state['seen'].add(getattr(result.get('document'), 'id', None))
             title = result.get('title', 'Неизвестный трек')
             performer = result.get('performer', '')
             
@@ -876,14 +2419,43 @@ class SheoMusMod(loader.Module):
             buttons.append([{
                 "text": f"{display_name}",
                 "callback": self._send_music_callback,
-                "args": (result['document'], message)
+                "args": (result['document'], message, query, result.get('bot', ''))
+            }])
+        
+        state['shown'] += len(results[:10])
+        
+        if has_more:
+            buttons.append([{
+                "text": "Ещё",
+                "callback": self._more_music_callback,
+                "args": (query, message, page_token)
             }])
         
         buttons.append([{"text": "Закрыть", "action": "close"}])
         
         return buttons
 
-    async def _send_music_callback(self, call, document, original_message):
+    async def _more_music_callback(self, call, query, original_message, page_token):
+        """Callback для загрузки следующей страницы результатов"""
+        try:
+            if not self._get_page_state(page_token):
+                await call.answer("Результаты устарели, повторите поиск", show_alert=True)
+                return
+            
+            if self.emojis_enabled:
+                await call.answer(self.clock_emoji())
+            else:
+                await call.answer()
+            
+            await call.edit(
+                "Выберите трек:",
+                reply_markup=await self._build_music_buttons(query, original_message, page_token)
+            )
+        except Exception as e:
+            logger.error(f"Ошибка в _more_music_callback: {e}")
+            await call.answer(f"Ошибка: {str(e)}", show_alert=True)
+
+    async def _send_music_callback(self, call, document, original_message, query=None, bot_username=None):
         """Callback для отправки выбранной музыки"""
         try:
             if self.emojis_enabled:
@@ -899,6 +2471,9 @@ class SheoMusMod(loader.Module):
                 original_message
             )
             
+            self.record_pick(bot_username, query)
+            self._record_bot_hit(document)
+            
         except Exception as e:
             logger.error(f"Ошибка в _send_music_callback: {e}")
             await call.answer(f"Ошибка: {str(e)}", show_alert=True)
@@ -916,7 +2491,7 @@ class SheoMusMod(loader.Module):
         if chat_id == "0":
             return
         
-        if chat_id not in self.allowed_chats:
+        if chat_id not in self.settings.allowed_chat_set:
             return
 
         text_lower = message.text.lower()
@@ -929,7 +2504,12 @@ class SheoMusMod(loader.Module):
             
             search_query = message.text[6:]
             if search_query:
-                await self._execute_search_and_send(message, search_query)
+                await self._enqueue_or_reject(
+                    chat_id,
+                    message,
+                    functools.partial(self._execute_search_and_send, budget=self.config["deadline_find"]),
+                    search_query
+                )
         
         elif text_lower.startswith("найтими "):
             user_id = message.sender_id
@@ -941,40 +2521,285 @@ class SheoMusMod(loader.Module):
             if not search_query:
                 return
             
-            emoji_message = None
+            await self._enqueue_or_reject(chat_id, message, self._execute_inline_search, search_query)
+
+    async def _execute_inline_search(self, message, search_query):
+        """Поиск с выбором трека через инлайн-форму"""
+        emoji_message = None
+        try:
+            if self.emojis_enabled:
+                emoji_message = await self._safe_respond(message, self.clock_emoji())
+            
+            await self._safe_delete(message)
+            
+            if emoji_message:
+                await self.inline.form(
+                    text="Выберите трек:",
+                    message=emoji_message,
+                    reply_markup=await self._build_music_buttons(search_query, message),
+                    silent=True
+                )
+            else:
+                temp_msg = await self._safe_respond(message, "Выберите трек:")
+                await self.inline.form(
+                    text="Выберите трек:",
+                    message=temp_msg,
+                    reply_markup=await self._build_music_buttons(search_query, message),
+                    silent=True
+                )
+        except Exception as e:
+            logger.error(f"Ошибка в watcher найтими: {e}")
+            error_message = await self._safe_respond(message, f"Ошибка: {str(e)}")
+            self.schedule_delete(error_message, 3)
+
+    async def _enqueue_or_reject(self, chat_id, message, handler, search_query):
+        """Ставит поиск в очередь или сообщает пользователю о перегрузке"""
+        if self.enqueue_search(chat_id, handler, message, search_query):
+            return
+        
+        await self._safe_delete(message)
+        error_message = await self._safe_respond(message, "Слишком много запросов, попробуйте позже.")
+        self.schedule_delete(error_message, 3)
+
+    def enqueue_search(self, chat_id, handler, *args):
+        """Добавляет поиск в очередь чата; возвращает False, если очередь заполнена"""
+        chat_queue = self.search_queues.get(chat_id)
+        
+        if (
+            self._queue_size >= self.config["queue_max_depth"]
+            or (chat_queue and len(chat_queue) >= self.config["queue_chat_depth"])
+        ):
+            self.queue_metrics['shed'] += 1
+            return False
+        
+        if chat_queue is None:
+            chat_queue = self.search_queues[chat_id] = collections.deque()
+            self._queue_order.append(chat_id)
+        
+        chat_queue.append((time.time(), handler, args))
+        self._queue_size += 1
+        self.queue_metrics['max_depth'] = max(self.queue_metrics['max_depth'], self._queue_size)
+        
+        if self._queue_wakeup:
+            self._queue_wakeup.set()
+        return True
+
+    def _start_search_workers(self):
+        """Запускает обработчики очереди поиска"""
+        if self._queue_workers:
+            return
+        self._queue_wakeup = asyncio.Event()
+        self._queue_workers = [
+            asyncio.ensure_future(self._search_worker())
+            for _ in range(self.config["queue_workers"])
+        ]
+
+    async def _stop_search_workers(self):
+        """Останавливает обработчики и очищает очередь поиска"""
+        for worker in self._queue_workers:
+            worker.cancel()
+        for worker in self._queue_workers:
             try:
-                if self.emojis_enabled:
-                    emoji_message = await self._safe_respond(message, self.clock_emoji())
-                
-                await self._safe_delete(message)
-                
-                if emoji_message:
-                    await self.inline.form(
-                        text="Выберите трек:",
-                        message=emoji_message,
-                        reply_markup=await self._build_music_buttons(search_query, message),
-                        silent=True
-                    )
-                else:
-                    temp_msg = await self._safe_respond(message, "Выберите трек:")
-                    await self.inline.form(
-                        text="Выберите трек:",
-                        message=temp_msg,
-                        reply_markup=await self._build_music_buttons(search_query, message),
-                        silent=True
-                    )
+                await worker
+            except (asyncio.CancelledError, Exception):
+                pass
+        
+        self._queue_workers = []
+        self.search_queues.clear()
+        self._queue_order.clear()
+        self._queue_size = 0
+
+    async def _search_worker(self):
+        """Берет задачи из очередей чатов по кругу"""
+        while True:
+            if not self._queue_order:
+                self._queue_wakeup.clear()
+                await self._queue_wakeup.wait()
+                continue
+            
+            chat_id = self._queue_order.popleft()
+            chat_queue = self.search_queues[chat_id]
+            enqueued_at, handler, args = chat_queue.popleft()
+            self._queue_size -= 1
+            
+            if chat_queue:
+                self._queue_order.append(chat_id)
+            else:
+                del self.search_queues[chat_id]
+            
+            self.queue_metrics['waits'].append(time.time() - enqueued_at)
+            
+            try:
+                await handler(*args)
             except Exception as e:
-                logger.error(f"Ошибка в watcher найтими: {e}")
-                error_message = await self._safe_respond(message, f"Ошибка: {str(e)}")
-                await self.delete_after(error_message, 3)
+                logger.error(f"Ошибка в обработчике очереди поиска: {e}")
+            finally:
+                self.queue_metrics['processed'] += 1
 
     async def delete_after(self, message, seconds):
         """Удаляет сообщение через указанное количество секунд"""
+        self.schedule_delete(message, seconds)
+
+    def schedule_delete(self, message, seconds):
+        """Планирует удаление сообщения, не блокируя вызывающий код"""
+        if not message:
+            return
+        
+        heapq.heappush(
+            self.deletion_queue,
+            (time.time() + seconds, next(self._deletion_counter), message)
+        )
+        if self._deletion_wakeup:
+            self._deletion_wakeup.set()
+
+    def _start_deletion_scheduler(self):
+        """Запускает фоновую очередь отложенных удалений"""
+        if self._deletion_task and not self._deletion_task.done():
+            return
+        self._deletion_wakeup = asyncio.Event()
+        self._deletion_task = asyncio.ensure_future(self._deletion_loop())
+
+    async def _stop_deletion_scheduler(self):
+        """Останавливает очередь удалений и удаляет все ожидающие сообщения"""
+        if self._deletion_task:
+            self._deletion_task.cancel()
+            try:
+                await self._deletion_task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._deletion_task = None
+        
+        pending = [entry[2] for entry in self.deletion_queue]
+        self.deletion_queue.clear()
+        if pending:
+            await self._delete_messages(pending)
+
+    async def _deletion_loop(self):
+        """Удаляет сообщения по мере наступления их срока"""
+        while True:
+            timeout = None
+            if self.deletion_queue:
+                timeout = self.deletion_queue[0][0] - time.time()
+            
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self._deletion_wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self._deletion_wakeup.clear()
+            
+            due = []
+            now = time.time()
+            while self.deletion_queue and self.deletion_queue[0][0] <= now:
+                due.append(heapq.heappop(self.deletion_queue)[2])
+            
+            if due:
+                try:
+                    await self._delete_messages(due)
+                except Exception as e:
+                    logger.error(f"Ошибка в очереди удаления: {e}")
+
+    async def _delete_messages(self, messages):
+        """Удаляет сообщения одним запросом delete_messages на каждый чат"""
+        grouped = {}
+        for message in messages:
+            chat_id = getattr(message, 'chat_id', None)
+            if chat_id is None or not isinstance(getattr(message, 'id', None), int):
+                await self._safe_delete(message)
+                continue
+            grouped.setdefault(chat_id, []).append(message)
+        
+        for chat_messages in grouped.values():
+            first = chat_messages[0]
+            peer = getattr(first, 'peer_id', None) or getattr(first, 'to_id', None) or first.chat_id
+            try:
+                await self.client.delete_messages(peer, [m.id for m in chat_messages])
+            except Exception as e:
+                logger.debug(f"Пакетное удаление не удалось, удаляем по одному: {e}")
+                for message in chat_messages:
+                    await self._safe_delete(message)
+
+    @loader.command(
+        ru_doc="Показывает состояние очереди поиска без префикса",
+        en_doc="Shows prefix-less search queue metrics"
+    )
+    async def queuemcmd(self, message):
+        """Метрики очереди поиска"""
+        metrics = self.queue_metrics
+        waits = list(metrics['waits'])
+        avg_wait = sum(waits) / len(waits) if waits else 0
+        max_wait = max(waits) if waits else 0
+        
+        text = "Очередь поиска:\n\n"
+        text += f"В очереди: {self._queue_size} (чатов: {len(self.search_queues)})\n"
+        text += f"Максимальная глубина: {metrics['max_depth']}\n"
+        text += f"Выполнено: {metrics['processed']}\n"
+        text += f"Отклонено: {metrics['shed']}\n"
+        text += f"Ожидание: среднее {avg_wait:.2f} с, максимальное {max_wait:.2f} с"
+        await self._safe_edit(message, text)
+
+    @loader.command(
+        ru_doc="[количество] - Воспроизводит записанные поиски с текущими настройками",
+        en_doc="[count] - Replays captured searches against the current settings"
+    )
+    async def replaymcmd(self, message):
+        """Воспроизвести журнал поиска"""
+        args = utils.get_args_raw(message)
+        limit = int(args) if args.isdigit() else 100
+        
         try:
-            await asyncio.sleep(seconds)
-            await self._safe_delete(message)
-        except Exception:
-            pass
+            records = await asyncio.get_running_loop().run_in_executor(
+                None, self._read_capture, self.config["capture_path"], limit
+            )
+        except OSError as e:
+            await self._safe_edit(message, f"Не удалось прочитать журнал поиска: {e}")
+            return
+        records = [record for record in records if record.get('answers') is not None]
+        if not records:
+            await self._safe_edit(message, "Журнал поиска пуст! Включите capture_enabled в конфиге")
+            return
+        
+        await self._safe_edit(message, f"Воспроизвожу {len(records)} поисков...")
+        # Записи воспроизводятся по одной в отдельном потоке: порядок ответов ботов
+        # определяется только записанными задержками, а не нагрузкой юзербота
+        replayed = await asyncio.get_running_loop().run_in_executor(
+            None, self._run_replay, records, self._replay_snapshot()
+        )
+        # Запрос без записанного ответа мгновенно возвращает пустой результат и искажает
+        # задержку и совпадение выбора - такие записи считаются отдельно
+        outcomes = [o for o in replayed if not o['missing']]
+        incomplete = len(replayed) - len(outcomes)
+        if not outcomes:
+            await self._safe_edit(
+                message,
+                f"Не удалось полностью воспроизвести ни одного поиска (неполных записей: {incomplete})"
+            )
+            return
+        
+        def p95(values):
+            values = sorted(values)
+            return values[min(len(values) - 1, int(len(values) * 0.95))]
+        
+        old_latency = [o['record'].get('latency_ms', 0) for o in outcomes]
+        new_latency = [o['latency_ms'] for o in outcomes]
+        agree = sum(1 for o in outcomes if o['agree'])
+        
+        text = f"Воспроизведено поисков: {len(outcomes)} из {len(records)}\n"
+        text += f"Не учтено из-за незаписанных ответов бота: {incomplete}\n\n"
+        text += f"Совпадение выбора: {agree}/{len(outcomes)} ({agree * 100 // len(outcomes)}%)\n"
+        text += (
+            f"Задержка в журнале: средняя {int(statistics.mean(old_latency))} мс, "
+            f"p95 {p95(old_latency)} мс\n"
+        )
+        text += (
+            f"Задержка при воспроизведении: средняя {int(statistics.mean(new_latency))} мс, "
+            f"p95 {p95(new_latency)} мс\n"
+        )
+        text += (
+            f"Инлайн-запросов: {sum(o['queries'] for o in outcomes)} "
+            f"(в журнале {sum(o['record'].get('queries', 0) for o in outcomes)})"
+        )
+        await self._safe_edit(message, text)
 
     @loader.command(
         ru_doc="Включает/выключает эмодзи в сообщениях модуля",
@@ -1037,29 +2862,78 @@ class SheoMusMod(loader.Module):
         else:
             await self._safe_edit(message, "Этот чат не найден в списке.")
 
+    async def _resolve_chat_titles(self, chat_ids):
+        """Возвращает названия чатов из кэша, параллельно догружая недостающие"""
+        titles = dict(self.database.get("SheoMus", "chat_titles", {}) or {})
+        now = time.time()
+        
+        def is_fresh(entry):
+            ttl = 86400 if entry.get('title') is not None else 3600
+            return now - entry.get('time', 0) < ttl
+        
+        missing = [c for c in chat_ids if c not in titles or not is_fresh(titles[c])]
+        
+        if missing:
+            semaphore = asyncio.Semaphore(5)
+            
+            async def resolve(chat_id):
+                async with semaphore:
+                    try:
+                        if chat_id and chat_id.lstrip('-').isdigit():
+                            chat = await self.client.get_entity(int(chat_id))
+                            return chat_id, getattr(chat, 'title', 'Личные сообщения')
+                    except Exception as e:
+                        logger.error(f"Ошибка получения чата {chat_id}: {e}")
+                    return chat_id, None
+            
+            for chat_id, title in await asyncio.gather(*(resolve(c) for c in missing)):
+                titles[chat_id] = {'title': title, 'time': now}
+            
+            if len(titles) > 1000:
+                newest = sorted(titles.items(), key=lambda x: x[1].get('time', 0), reverse=True)
+                titles = dict(newest[:1000])
+            
+            self.database.set("SheoMus", "chat_titles", titles)
+        
+        return {c: titles[c].get('title') for c in chat_ids if c in titles}
+
     @loader.command(
-        ru_doc="Показывает список чатов, где команда работает без префикса",
-        en_doc="Shows list of chats where command works without prefix"
+        ru_doc="[страница] - Показывает список чатов, где команда работает без префикса",
+        en_doc="[page] - Shows list of chats where command works without prefix"
     )
     async def listmcmd(self, message):
         """Список разрешенных чатов"""
         allowed_chats_list = self.allowed_chats
         if not allowed_chats_list:
             await self._safe_edit(message, "Список разрешенных чатов пуст.")
-        else:
-            text = "Разрешенные чаты:\n\n"
-            for chat_id in allowed_chats_list:
-                try:
-                    if chat_id and chat_id.lstrip('-').isdigit():
-                        chat = await self.client.get_entity(int(chat_id))
-                        title = getattr(chat, 'title', 'Личные сообщения')
-                        text += f"• {title} ({chat_id})\n"
-                    else:
-                        text += f"• Неизвестный чат ({chat_id})\n"
-                except Exception as e:
-                    logger.error(f"Ошибка получения чата {chat_id}: {e}")
-                    text += f"• Неизвестный чат ({chat_id})\n"
-            await self._safe_edit(message, text)
+            return
+        
+        page_size = 30
+        pages = (len(allowed_chats_list) + page_size - 1) // page_size
+        args = utils.get_args_raw(message)
+        page = int(args) if args and args.strip().isdigit() else 1
+        page = max(1, min(page, pages))
+        
+        page_chats = allowed_chats_list[(page - 1) * page_size:page * page_size]
+        titles = await self._resolve_chat_titles(page_chats)
+        
+        text = "Разрешенные чаты:\n\n"
+        if pages > 1:
+            text = f"Разрешенные чаты (страница {page}/{pages}):\n\n"
+        
+        for chat_id in page_chats:
+            title = titles.get(chat_id)
+            if title is None:
+                text += f"• Неизвестный чат ({chat_id})\n"
+            else:
+                if len(title) > 64:
+                    title = title[:61] + "..."
+                text += f"• {title} ({chat_id})\n"
+        
+        if page < pages:
+            text += f"\nСледующая страница: listm {page + 1}"
+        
+        await self._safe_edit(message, text)
 
     @loader.command(
         ru_doc="Показывает список ботов для поиска музыки",
@@ -1074,8 +2948,25 @@ class SheoMusMod(loader.Module):
             
         text = "Боты для поиска музыки:\n\n"
         for i, bot in enumerate(bots, 1):
-            status = " (недоступен)" if self.is_bot_failed(bot) else ""
+            unresolved = self.unresolved_bots.get(bot.lower())
+            if unresolved:
+                status = f" (не найден: {unresolved[1]})"
+            elif self.is_bot_failed(bot):
+                status = " (недоступен)"
+            else:
+                status = ""
             text += f"{i}. @{bot}{status}\n"
+            
+            stats = self.bot_stats.get(bot.lower())
+            if stats:
+                text += (
+                    f"    отправлено {stats['hits']}/{stats['queries']}, "
+                    f"пустых {stats['empty']}, {int(stats['latency'] * 1000)} мс\n"
+                )
+            
+            cache_hits, cache_misses = self.raw_cache_stats.get(bot.lower(), (0, 0))
+            if cache_hits or cache_misses:
+                text += f"    кэш ответов: {cache_hits} попаданий, {cache_misses} промахов\n"
         await self._safe_edit(message, text)
 
     @loader.command(
@@ -1095,14 +2986,21 @@ class SheoMusMod(loader.Module):
             await self._safe_edit(message, "Некорректный username бота!")
             return
         
-        existing_bots_lower = [b.lower() for b in self.music_bots]
-        if bot_username in existing_bots_lower:
+        if bot_username in self.settings.bots_lower:
             await self._safe_edit(message, "Этот бот уже есть в списке!")
         else:
             current_bots_list = self.music_bots.copy()
             current_bots_list.append(bot_username)
             self.music_bots = current_bots_list
-            await self._safe_edit(message, f"Бот @{bot_username} добавлен в список!")
+            self.negative_cache.clear()
+            await self._resolve_bot_peers([bot_username])
+            if bot_username in self.unresolved_bots:
+                await self._safe_edit(
+                    message,
+                    f"Бот @{bot_username} добавлен в список, но не найден и пока исключен из поиска!"
+                )
+            else:
+                await self._safe_edit(message, f"Бот @{bot_username} добавлен в список!")
 
     @loader.command(
         ru_doc="<юзернейм> - Удаляет бота из списка для поиска музыки",
@@ -1127,9 +3025,12 @@ class SheoMusMod(loader.Module):
         
         if found:
             self.music_bots = current_bots_list
+            self.negative_cache.clear()
             for key in list(self.failed_bots.keys()):
                 if key.lower() == bot_username:
                     del self.failed_bots[key]
+            self.bot_peers.pop(bot_username, None)
+            self.unresolved_bots.pop(bot_username, None)
             await self._safe_edit(message, f"Бот @{bot_username} удален из списка!")
         else:
             await self._safe_edit(message, "Этот бот не найден в списке!")
@@ -1158,6 +3059,9 @@ class SheoMusMod(loader.Module):
         
         self.music_bots = default_bots.copy()
         self.failed_bots.clear()
+        self.negative_cache.clear()
+        self.unresolved_bots.clear()
+        self._schedule_resolve(default_bots)
         
         text = "Список ботов сброшен к исходному:\n\n"
         for i, bot in enumerate(default_bots, 1):